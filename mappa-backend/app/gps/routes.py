@@ -1,9 +1,195 @@
-from flask import Blueprint, request, jsonify
+from datetime import datetime
+from flask import Blueprint, request, jsonify, current_app
 from flask_jwt_extended import jwt_required, get_jwt_identity
+import numpy as np
 from .. import supabase
 
 gps_bp = Blueprint('gps', __name__)
 
+GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
+HEATMAP_PRECISIONS = (4, 5, 6, 7)
+DEFAULT_HEATMAP_PRECISION = 6
+HEATMAP_PAGE_SIZE = 1000
+# Upper bound on geohash prefixes used to push a bbox filter into the query
+MAX_HEATMAP_PREFIXES = 32
+
+DEFAULT_HISTORY_POINTS = 500
+MAX_HISTORY_POINTS = 5000
+# The database buckets the range into this many slices per target point
+# (see location_history_candidates) and Douglas-Peucker ranks what comes back,
+# so the backend never downloads more than a bounded candidate set.
+BUCKET_OVERSAMPLE = 4
+
+
+def encode_geohash(lat, lng, precision):
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    bit_count = 0
+    even = True
+    while len(chars) < precision:
+        rng, value = (lng_range, lng) if even else (lat_range, lat)
+        mid = (rng[0] + rng[1]) / 2
+        if value >= mid:
+            bits = (bits << 1) | 1
+            rng[0] = mid
+        else:
+            bits = bits << 1
+            rng[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(GEOHASH_ALPHABET[bits])
+            bits = 0
+            bit_count = 0
+    return "".join(chars)
+
+
+def decode_geohash_bbox(cell):
+    """Return (min_lng, min_lat, max_lng, max_lat) covered by a geohash cell"""
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    even = True
+    for char in cell:
+        value = GEOHASH_ALPHABET.index(char)
+        for shift in range(4, -1, -1):
+            rng = lng_range if even else lat_range
+            mid = (rng[0] + rng[1]) / 2
+            if (value >> shift) & 1:
+                rng[0] = mid
+            else:
+                rng[1] = mid
+            even = not even
+    return lng_range[0], lat_range[0], lng_range[1], lat_range[1]
+
+
+def geohash_prefixes_for_bbox(bbox, precision):
+    """Return the longest geohash prefixes (at most `precision` long) covering a bbox
+
+    Picks the finest prefix length whose covering cells fit in
+    MAX_HEATMAP_PREFIXES, so a bbox becomes a handful of LIKE filters.
+    """
+    min_lng, min_lat, max_lng, max_lat = bbox
+    for length in range(precision, 0, -1):
+        lng_bits = (5 * length + 1) // 2
+        lat_bits = 5 * length // 2
+        width = 360.0 / (1 << lng_bits)
+        height = 180.0 / (1 << lat_bits)
+        x0 = max(int((min_lng + 180) // width), 0)
+        x1 = min(int((max_lng + 180) // width), (1 << lng_bits) - 1)
+        y0 = max(int((min_lat + 90) // height), 0)
+        y1 = min(int((max_lat + 90) // height), (1 << lat_bits) - 1)
+        if (x1 - x0 + 1) * (y1 - y0 + 1) <= MAX_HEATMAP_PREFIXES:
+            return [
+                encode_geohash(-90 + (y + 0.5) * height, -180 + (x + 0.5) * width, length)
+                for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)
+            ]
+    return []
+
+
+def update_heatmap_cells(user_id, lat, lng):
+    """Increment the precomputed heatmap cells containing a fix, one per precision"""
+    cells = [encode_geohash(lat, lng, p) for p in HEATMAP_PRECISIONS]
+    supabase.rpc('increment_location_heat', {"p_user_id": user_id, "p_cells": cells}).execute()
+
+
+def time_bucket_indices(times, n_buckets):
+    """Indices of at least n_buckets fixes spread over time and over the sample
+
+    The first fix of each occupied time slice keeps sparse stretches visible,
+    and an even stride over the samples fills in when fixes come in clusters
+    (e.g. daily walks) and most time slices are empty.
+    """
+    n = len(times)
+    stride = np.linspace(0, n - 1, n_buckets).astype(np.int64)
+    span = times[-1] - times[0]
+    if span <= 0:
+        return np.unique(stride)
+    buckets = ((times - times[0]) / span * (n_buckets - 1)).astype(np.int64)
+    _, first = np.unique(buckets, return_index=True)
+    return np.union1d(first, stride)
+
+
+def douglas_peucker_ranks(xy, limit=None):
+    """Rank every point by its Douglas-Peucker significance
+
+    Each point's rank is the perpendicular distance at which Douglas-Peucker
+    would keep it, capped by its parent's so that taking the top-k ranks
+    yields the same shape a tolerance-based run would. Endpoints rank highest.
+    All intervals of one recursion level are split together in a single pass.
+    With a limit, intervals that can no longer reach the top `limit` ranks are
+    dropped and their points keep a rank of zero.
+    """
+    n = len(xy)
+    ranks = np.zeros(n)
+    ranks[0] = ranks[-1] = np.inf
+    starts = np.array([0])
+    ends = np.array([n - 1])
+    caps = np.array([np.inf])
+    while True:
+        wide = ends - starts >= 2
+        ranked = np.count_nonzero(ranks)
+        if limit is not None and ranked > limit:
+            # Descendants never outrank their interval's cap
+            threshold = np.partition(ranks, n - limit)[n - limit]
+            wide &= caps >= threshold
+        starts, ends, caps = starts[wide], ends[wide], caps[wide]
+        if not len(starts):
+            return ranks
+
+        # Flatten the interior points of every interval, tagged by interval
+        counts = ends - starts - 1
+        offsets = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        owner = np.repeat(np.arange(len(starts)), counts)
+        index = starts[owner] + 1 + np.arange(counts.sum()) - offsets[owner]
+
+        seg = xy[ends] - xy[starts]
+        seg_len = np.hypot(seg[:, 0], seg[:, 1])
+        rel = xy[index] - xy[starts[owner]]
+        seg_o = seg[owner]
+        cross = np.abs(seg_o[:, 0] * rel[:, 1] - seg_o[:, 1] * rel[:, 0])
+        len_o = seg_len[owner]
+        dists = np.where(len_o > 0, cross / np.where(len_o > 0, len_o, 1.0), np.hypot(rel[:, 0], rel[:, 1]))
+
+        # Farthest point of each interval: first point hitting the interval's max
+        peak = np.maximum.reduceat(dists, offsets)
+        hits = np.flatnonzero(dists == peak[owner])
+        first = np.concatenate(([True], np.diff(owner[hits]) != 0))
+        split = index[hits[first]]
+        rank = np.minimum(peak, caps)
+        ranks[split] = rank
+
+        starts, ends = np.concatenate((starts, split)), np.concatenate((split, ends))
+        caps = np.concatenate((rank, rank))
+
+
+def downsample_fixes(lats, lngs, times, max_points):
+    """Reduce a fix history to at most max_points indices, preserving shape"""
+    n = len(lats)
+    if n <= max_points:
+        return np.arange(n)
+
+    candidates = np.arange(n)
+    if n > max_points * BUCKET_OVERSAMPLE:
+        candidates = time_bucket_indices(times, max_points * BUCKET_OVERSAMPLE)
+    if len(candidates) <= max_points:
+        return candidates
+
+    # Equirectangular projection is accurate enough to compare deviations
+    lat_c = lats[candidates]
+    scale = np.cos(np.radians(lat_c.mean()))
+    xy = np.column_stack((lngs[candidates] * scale, lat_c))
+
+    ranks = douglas_peucker_ranks(xy, max_points)
+    keep = np.sort(np.argpartition(-ranks, max_points - 1)[:max_points])
+    return candidates[keep]
+
+
+def parse_timestamp(value):
+    return datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+
 @gps_bp.route('/locations', methods=['POST'])
 @jwt_required()
 def save_location():
@@ -18,4 +204,113 @@ def save_location():
         supabase.table('Location').insert(loc_data).execute()
     except Exception as e:
         return jsonify({"msg": "Failed to save location.", "error": str(e)}), 500
-    return jsonify({"msg": "Location saved."})
\ No newline at end of file
+    try:
+        update_heatmap_cells(user_id, float(data['lat']), float(data['lng']))
+    except Exception as e:
+        # The fix itself is stored; a missed heatmap increment must not make the client retry
+        current_app.logger.warning("Failed to update location heatmap: %s", e)
+    return jsonify({"msg": "Location saved."})
+
+
+@gps_bp.route('/locations', methods=['GET'])
+@jwt_required()
+def get_location_history():
+    """Return fixes in a time range, downsampled server-side to max_points
+
+    Time bucketing runs in the database; only the bucket candidates are
+    fetched and then ranked with Douglas-Peucker.
+    """
+    user_id = get_jwt_identity()
+    start = request.args.get('start')
+    end = request.args.get('end')
+    try:
+        if start:
+            parse_timestamp(start)
+        if end:
+            parse_timestamp(end)
+        max_points = int(request.args.get('max_points', DEFAULT_HISTORY_POINTS))
+    except ValueError:
+        return jsonify({"msg": "Invalid 'start', 'end' or 'max_points'."}), 400
+    if max_points < 2:
+        return jsonify({"msg": "'max_points' must be at least 2."}), 400
+    max_points = min(max_points, MAX_HISTORY_POINTS)
+
+    try:
+        res = supabase.rpc('location_history_candidates', {
+            "p_user_id": user_id,
+            "p_start": start,
+            "p_end": end,
+            "p_buckets": max_points * BUCKET_OVERSAMPLE
+        }).execute()
+    except Exception as e:
+        return jsonify({"msg": "Failed to fetch location history.", "error": str(e)}), 500
+
+    total = res.data['total']
+    fixes = res.data['fixes']
+    if not fixes:
+        return jsonify({"locations": [], "total": total, "returned": 0})
+
+    lats = np.fromiter((f['lat'] for f in fixes), dtype=np.float64, count=len(fixes))
+    lngs = np.fromiter((f['lng'] for f in fixes), dtype=np.float64, count=len(fixes))
+    times = np.fromiter((parse_timestamp(f['timestamp']).timestamp() for f in fixes), dtype=np.float64, count=len(fixes))
+    keep = downsample_fixes(lats, lngs, times, max_points)
+
+    return jsonify({
+        "locations": [fixes[i] for i in keep.tolist()],
+        "total": total,
+        "returned": len(keep)
+    })
+
+@gps_bp.route('/heatmap', methods=['GET'])
+@jwt_required()
+def get_heatmap():
+    """Return precomputed geohash heatmap cells, optionally limited to a bbox"""
+    user_id = get_jwt_identity()
+    try:
+        precision = int(request.args.get('precision', DEFAULT_HEATMAP_PRECISION))
+    except ValueError:
+        return jsonify({"msg": "Invalid 'precision'."}), 400
+    if precision not in HEATMAP_PRECISIONS:
+        return jsonify({"msg": f"'precision' must be one of {list(HEATMAP_PRECISIONS)}."}), 400
+
+    bbox = None
+    if request.args.get('bbox'):
+        try:
+            bbox = [float(v) for v in request.args['bbox'].split(',')]
+        except ValueError:
+            bbox = None
+        if not bbox or len(bbox) != 4 or bbox[0] > bbox[2] or bbox[1] > bbox[3]:
+            return jsonify({"msg": "'bbox' must be 'min_lng,min_lat,max_lng,max_lat'."}), 400
+
+    prefixes = geohash_prefixes_for_bbox(bbox, precision) if bbox else []
+
+    rows = []
+    try:
+        offset = 0
+        while True:
+            query = supabase.table('LocationHeatCell').select('cell, count').eq('user_id', user_id).eq('precision', precision)
+            if prefixes:
+                query = query.or_(",".join(f"cell.like.{prefix}*" for prefix in prefixes))
+            res = query.order('cell').range(offset, offset + HEATMAP_PAGE_SIZE - 1).execute()
+            rows.extend(res.data)
+            if len(res.data) < HEATMAP_PAGE_SIZE:
+                break
+            offset += HEATMAP_PAGE_SIZE
+    except Exception as e:
+        return jsonify({"msg": "Failed to fetch heatmap.", "error": str(e)}), 500
+
+    cells = []
+    for row in rows:
+        # Prefix cells overhang the bbox, so trim to cells that actually intersect it
+        min_lng, min_lat, max_lng, max_lat = decode_geohash_bbox(row['cell'])
+        if bbox and (max_lng < bbox[0] or min_lng > bbox[2] or max_lat < bbox[1] or min_lat > bbox[3]):
+            continue
+        cells.append({
+            "cell": row['cell'],
+            "lat": (min_lat + max_lat) / 2,
+            "lng": (min_lng + max_lng) / 2,
+            "bbox": [min_lng, min_lat, max_lng, max_lat],
+            "count": row['count']
+        })
+
+    return jsonify({"precision": precision, "cells": cells})
@@ -1,8 +1,15 @@
 import os
-from flask import Blueprint, request, jsonify
+import threading
+from collections import OrderedDict
+from flask import Blueprint, request, jsonify, Response
 from flask_jwt_extended import jwt_required, get_jwt_identity
+import mapbox_vector_tile
+import numpy as np
 import requests
-from shapely.geometry import LineString
+from shapely import linestrings, points
+from shapely.geometry import LineString, box
+from shapely.ops import clip_by_rect
+from shapely.strtree import STRtree
 
 from .. import supabase
 
@@ -11,9 +18,244 @@ mapping_bp = Blueprint('mapping', __name__)
 ORS_API_KEY = os.getenv("ORS_API_KEY")
 ORS_BASE_URL = "https://api.openrouteservice.org/v2/directions"
 
+METERS_PER_DEGREE = 111000.0
+OFF_ROUTE_METERS = 30.0
+MAX_PROGRESS_FIXES = 50
+ROUTE_TRACK_CACHE_SIZE = 256
+
+# shape_id -> precomputed segment arrays, most recently used last
+_route_track_cache = OrderedDict()
+# shape_id -> number of invalidations, so loads that raced an edit are not cached
+_route_track_generations = {}
+_route_track_lock = threading.Lock()
+
+WEB_MERCATOR_RADIUS = 6378137.0
+WEB_MERCATOR_MAX_LAT = 85.05112878
+TILE_EXTENT = 4096
+TILE_BUFFER = 64
+TILE_SIMPLIFY_TOLERANCE = 1.0
+MAX_TILE_ZOOM = 22
+ROUTE_TILE_USERS = 64
+ROUTE_TILES_PER_USER = 512
+
+# user_id -> {"tree", "routes", "tiles", "generation"}, most recently used last.
+# Each entry holds the bbox index over the user's routes and their rendered tiles.
+_route_tile_cache = OrderedDict()
+# user_id -> number of invalidations, so loads that raced an edit are not cached
+_route_tile_generations = {}
+_route_tile_lock = threading.Lock()
+
 
 def meters_to_degrees(meters):
-    return meters / 111000.0
+    return meters / METERS_PER_DEGREE
+
+
+def build_route_track(snapped_route, directions):
+    """Precompute segment arrays used to project fixes onto a route
+
+    Coordinates are projected to local meters around the route's mean latitude,
+    which is accurate enough over the length of a walk or run. An STRtree over
+    the segments finds each fix's nearest segment without scanning the route.
+    """
+    coords = np.asarray(snapped_route, dtype=np.float64)[:, :2]
+    scale = np.array([METERS_PER_DEGREE * np.cos(np.radians(coords[:, 1].mean())), METERS_PER_DEGREE])
+    xy = coords * scale
+    vectors = xy[1:] - xy[:-1]
+    len2 = np.einsum('ij,ij->i', vectors, vectors)
+    seg_len = np.sqrt(len2)
+    steps = directions or []
+    return {
+        "scale": scale,
+        "tree": STRtree(linestrings(np.stack((xy[:-1], xy[1:]), axis=1))),
+        "starts": xy[:-1],
+        "vectors": vectors,
+        # Zero-length segments project every fix onto their start point
+        "inv_len2": np.divide(1.0, len2, out=np.zeros_like(len2), where=len2 > 0),
+        "seg_len": seg_len,
+        "cum": np.concatenate(([0.0], np.cumsum(seg_len))),
+        "steps": steps,
+        "step_starts": np.array([s['way_points'][0] for s in steps], dtype=np.int64),
+        "step_ends": np.array([s['way_points'][1] for s in steps], dtype=np.int64)
+    }
+
+
+def get_route_track(shape_id, user_id):
+    """Return the cached route track for a user's route, loading it on a miss"""
+    key = str(shape_id)
+    with _route_track_lock:
+        cached = _route_track_cache.get(key)
+        if cached is not None:
+            _route_track_cache.move_to_end(key)
+        generation = _route_track_generations.get(key, 0)
+    if cached is not None:
+        return cached["track"] if cached["user_id"] == str(user_id) else None
+
+    res = supabase.table('ShapeRoute').select('snapped_route, directions').eq('id', shape_id).eq('user_id', user_id).execute()
+    if not res.data:
+        return None
+    shape = res.data[0]
+    snapped = shape.get('snapped_route') or []
+    if len(snapped) < 2:
+        return None
+
+    track = build_route_track(snapped, shape.get('directions'))
+    with _route_track_lock:
+        # A route edit landed while loading; use this track but don't cache it
+        if _route_track_generations.get(key, 0) == generation:
+            _route_track_cache[key] = {"user_id": str(user_id), "track": track}
+            if len(_route_track_cache) > ROUTE_TRACK_CACHE_SIZE:
+                _route_track_cache.popitem(last=False)
+    return track
+
+
+def invalidate_route_track(shape_id):
+    key = str(shape_id)
+    with _route_track_lock:
+        _route_track_generations[key] = _route_track_generations.get(key, 0) + 1
+        _route_track_cache.pop(key, None)
+
+
+def project_onto_track(track, fixes):
+    """Project [lng, lat] fixes onto a route track
+
+    The STRtree picks each fix's nearest segment, then the exact projection runs
+    vectorized over just those segments, so cost does not grow with route length.
+    """
+    xy = np.asarray(fixes, dtype=np.float64) * track["scale"]
+    fix_idx, seg_idx = track["tree"].query_nearest(points(xy), all_matches=False)
+    segments = np.empty(len(xy), dtype=np.int64)
+    segments[fix_idx] = seg_idx
+
+    rel = xy - track["starts"][segments]
+    vectors = track["vectors"][segments]
+    t = np.clip(np.einsum('ij,ij->i', rel, vectors) * track["inv_len2"][segments], 0.0, 1.0)
+    offsets = rel - t[:, None] * vectors
+    deviation = np.hypot(offsets[:, 0], offsets[:, 1])
+    along = track["cum"][segments] + t * track["seg_len"][segments]
+
+    if len(track["steps"]):
+        step_idx = np.searchsorted(track["step_starts"], segments, side='right') - 1
+        # Segments past the last step's range (e.g. later ORS segments) have no step
+        in_step = (step_idx >= 0) & (segments < track["step_ends"][np.maximum(step_idx, 0)])
+        step_idx = np.where(in_step, step_idx, -1)
+    else:
+        step_idx = np.full(len(xy), -1)
+
+    return segments, deviation, along, step_idx
+
+
+def lnglat_to_mercator(coords):
+    coords = np.asarray(coords, dtype=np.float64)[:, :2]
+    lat = np.clip(coords[:, 1], -WEB_MERCATOR_MAX_LAT, WEB_MERCATOR_MAX_LAT)
+    x = WEB_MERCATOR_RADIUS * np.radians(coords[:, 0])
+    y = WEB_MERCATOR_RADIUS * np.log(np.tan(np.pi / 4 + np.radians(lat) / 2))
+    return np.column_stack((x, y))
+
+
+def tile_bounds(z, x, y):
+    """Return (min_x, min_y, max_x, max_y) of a tile in Web Mercator meters"""
+    half_world = np.pi * WEB_MERCATOR_RADIUS
+    size = 2 * half_world / (1 << z)
+    min_x = -half_world + x * size
+    max_y = half_world - y * size
+    return min_x, max_y - size, min_x + size, max_y
+
+
+def get_route_tile_index(user_id):
+    """Return the cached bbox index over a user's routes, building it on a miss"""
+    key = str(user_id)
+    with _route_tile_lock:
+        cached = _route_tile_cache.get(key)
+        if cached is not None:
+            _route_tile_cache.move_to_end(key)
+            return cached
+        generation = _route_tile_generations.get(key, 0)
+
+    res = supabase.table('ShapeRoute').select('id, name, mode, snapped_route').eq('user_id', user_id).execute()
+    routes = []
+    for shape in res.data:
+        snapped = shape.get('snapped_route') or []
+        if len(snapped) < 2:
+            continue
+        routes.append({
+            "properties": {
+                "id": shape['id'],
+                "name": shape.get('name') or f"Route {shape['id']}",
+                "mode": shape.get('mode') or ''
+            },
+            "mercator": lnglat_to_mercator(snapped)
+        })
+
+    boxes = [box(*r["mercator"].min(axis=0), *r["mercator"].max(axis=0)) for r in routes]
+    cached = {
+        "tree": STRtree(boxes) if boxes else None,
+        "routes": routes,
+        "tiles": OrderedDict(),
+        "generation": generation
+    }
+    with _route_tile_lock:
+        # A route edit landed while loading; serve this index but don't cache it
+        if _route_tile_generations.get(key, 0) == generation:
+            _route_tile_cache[key] = cached
+            if len(_route_tile_cache) > ROUTE_TILE_USERS:
+                _route_tile_cache.popitem(last=False)
+    return cached
+
+
+def invalidate_route_tiles(user_id):
+    key = str(user_id)
+    with _route_tile_lock:
+        _route_tile_generations[key] = _route_tile_generations.get(key, 0) + 1
+        _route_tile_cache.pop(key, None)
+
+
+def render_route_tile(index, z, x, y):
+    """Encode the routes crossing a tile as a Mapbox Vector Tile
+
+    Geometries are moved into tile pixel space first, so clipping and
+    simplification both work in pixels regardless of zoom.
+    """
+    min_x, min_y, max_x, max_y = tile_bounds(z, x, y)
+    pixels_per_meter = TILE_EXTENT / (max_x - min_x)
+    buffer_m = TILE_BUFFER / pixels_per_meter
+
+    features = []
+    if index["tree"] is not None:
+        query = box(min_x - buffer_m, min_y - buffer_m, max_x + buffer_m, max_y + buffer_m)
+        for i in sorted(index["tree"].query(query).tolist()):
+            route = index["routes"][i]
+            pixels = (route["mercator"] - (min_x, min_y)) * pixels_per_meter
+            clipped = clip_by_rect(LineString(pixels), -TILE_BUFFER, -TILE_BUFFER,
+                                   TILE_EXTENT + TILE_BUFFER, TILE_EXTENT + TILE_BUFFER)
+            geometry = clipped.simplify(TILE_SIMPLIFY_TOLERANCE, preserve_topology=False)
+            if geometry.is_empty:
+                continue
+            features.append({"geometry": geometry, "properties": route["properties"]})
+
+    return mapbox_vector_tile.encode([{"name": "routes", "features": features}])
+
+
+def format_progress(track, segment, deviation, along, step_idx):
+    total = float(track["cum"][-1])
+    next_step = None
+    if 0 <= step_idx < len(track["steps"]) - 1:
+        step = track["steps"][step_idx + 1]
+        next_step = {
+            "index": int(step_idx + 1),
+            "instruction": step.get('instruction'),
+            "name": step.get('name'),
+            "type": step.get('type'),
+            "distance_m": max(float(track["cum"][step['way_points'][0]]) - along, 0.0)
+        }
+    return {
+        "segment_index": int(segment),
+        "distance_along_m": along,
+        "distance_remaining_m": max(total - along, 0.0),
+        "deviation_m": deviation,
+        "off_route": deviation > OFF_ROUTE_METERS,
+        "current_step_index": int(step_idx) if step_idx >= 0 else None,
+        "next_step": next_step
+    }
 
 
 def snap_waypoints_to_route(coords, mode='foot-walking'):
@@ -113,6 +355,7 @@ def map_shape():
             shape_id = res.data[0]['id'] if res.data else None
         except Exception as e:
             return jsonify({"error": str(e)}), 500
+        invalidate_route_tiles(user_id)
 
         export_url = generate_google_maps_url(snapped)
 
@@ -159,6 +402,7 @@ def snap_and_save_shape():
             shape_id = res.data[0]['id'] if res.data else None
         except Exception as e:
             return jsonify({"error": str(e)}), 500
+        invalidate_route_tiles(user_id)
 
         export_url = generate_google_maps_url(snapped)
 
@@ -260,6 +504,8 @@ def update_shape(shape_id):
             supabase.table('ShapeRoute').update(update_data).eq('id', shape_id).eq('user_id', user_id).execute()
         except Exception as e:
             return jsonify({"error": str(e)}), 500
+        invalidate_route_track(shape_id)
+        invalidate_route_tiles(user_id)
 
         return jsonify({"msg": "Route updated successfully", "snapped": snapped, "directions": directions}), 200
     except Exception as e:
@@ -287,6 +533,7 @@ def patch_shape(shape_id):
             supabase.table('ShapeRoute').update(allowed_updates).eq('id', shape_id).eq('user_id', user_id).execute()
         except Exception as e:
             return jsonify({"error": str(e)}), 500
+        invalidate_route_tiles(user_id)
 
         return jsonify({"msg": "Route updated successfully", "updated_fields": allowed_updates}), 200
     except Exception as e:
@@ -302,6 +549,8 @@ def delete_shape(shape_id):
             supabase.table('ShapeRoute').delete().eq('id', shape_id).eq('user_id', user_id).execute()
         except Exception as e:
             return jsonify({"error": str(e)}), 500
+        invalidate_route_track(shape_id)
+        invalidate_route_tiles(user_id)
 
         return jsonify({"msg": "Route deleted successfully"}), 200
     except Exception as e:
@@ -334,3 +583,80 @@ def snap_route():
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
+
+
+@mapping_bp.route('/shapes/<shape_id>/progress', methods=['POST'])
+@jwt_required()
+def route_progress(shape_id):
+    """Project a GPS fix (or a short batch) onto a saved route
+
+    Accepts either {"lat", "lng"} or {"fixes": [{"lat", "lng"}, ...]} and returns
+    distance along the route, off-route deviation and the next direction step.
+    """
+    try:
+        data = request.get_json()
+        user_id = get_jwt_identity()
+
+        raw_fixes = data.get('fixes') if 'fixes' in data else [data]
+        if not isinstance(raw_fixes, list) or not raw_fixes:
+            return jsonify({"error": "Missing 'lat'/'lng' or 'fixes'"}), 400
+        if len(raw_fixes) > MAX_PROGRESS_FIXES:
+            return jsonify({"error": f"At most {MAX_PROGRESS_FIXES} fixes per request"}), 400
+        try:
+            fixes = [[float(f['lng']), float(f['lat'])] for f in raw_fixes]
+        except (KeyError, TypeError, ValueError):
+            return jsonify({"error": "Each fix needs numeric 'lat' and 'lng'"}), 400
+
+        try:
+            track = get_route_track(shape_id, user_id)
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+        if track is None:
+            return jsonify({"error": "Route not found"}), 404
+
+        segments, deviation, along, step_idx = project_onto_track(track, fixes)
+        progress = [
+            dict(format_progress(track, segments[i], float(deviation[i]), float(along[i]), int(step_idx[i])),
+                 lat=fixes[i][1], lng=fixes[i][0])
+            for i in range(len(fixes))
+        ]
+
+        return jsonify({
+            "shape_id": shape_id,
+            "route_length_m": float(track["cum"][-1]),
+            "progress": progress
+        }), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@mapping_bp.route('/tiles/<int:z>/<int:x>/<int:y>.mvt', methods=['GET'])
+@jwt_required()
+def route_tile(z, x, y):
+    """Serve the user's routes clipped and simplified to one vector tile"""
+    try:
+        user_id = get_jwt_identity()
+        if z > MAX_TILE_ZOOM or x >= (1 << z) or y >= (1 << z):
+            return jsonify({"error": "Invalid tile coordinates"}), 400
+
+        try:
+            index = get_route_tile_index(user_id)
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+
+        tiles = index["tiles"]
+        with _route_tile_lock:
+            tile = tiles.get((z, x, y))
+            if tile is not None:
+                tiles.move_to_end((z, x, y))
+        if tile is None:
+            tile = render_route_tile(index, z, x, y)
+            with _route_tile_lock:
+                if _route_tile_generations.get(str(user_id), 0) == index["generation"]:
+                    tiles[(z, x, y)] = tile
+                    if len(tiles) > ROUTE_TILES_PER_USER:
+                        tiles.popitem(last=False)
+
+        return Response(tile, mimetype='application/vnd.mapbox-vector-tile')
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
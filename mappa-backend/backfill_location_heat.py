@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""
+Script to backfill LocationHeatCell from existing Location rows
+"""
+from collections import Counter
+from app import create_app
+
+PAGE_SIZE = 1000
+UPSERT_BATCH_SIZE = 500
+
+
+def count_heat_cells(supabase, encode_geohash, precisions):
+    counts = Counter()
+    last_id = None
+    scanned = 0
+    while True:
+        # Keyset paging on the primary key stays cheap however large the table gets
+        query = supabase.table('Location').select('id, user_id, latitude, longitude').order('id')
+        if last_id is not None:
+            query = query.gt('id', last_id)
+        res = query.limit(PAGE_SIZE).execute()
+        for row in res.data:
+            for precision in precisions:
+                cell = encode_geohash(float(row['latitude']), float(row['longitude']), precision)
+                counts[(row['user_id'], precision, cell)] += 1
+        scanned += len(res.data)
+        if len(res.data) < PAGE_SIZE:
+            return counts, scanned
+        last_id = res.data[-1]['id']
+        print(f"  scanned {scanned} locations...")
+
+
+def run_backfill():
+    print("Backfilling location heatmap cells...")
+
+    create_app()
+    from app import supabase
+    from app.gps.routes import encode_geohash, HEATMAP_PRECISIONS
+
+    try:
+        counts, scanned = count_heat_cells(supabase, encode_geohash, HEATMAP_PRECISIONS)
+        print(f"✓ Scanned {scanned} locations into {len(counts)} cells")
+
+        rows = [
+            {"user_id": user_id, "precision": precision, "cell": cell, "count": count}
+            for (user_id, precision, cell), count in counts.items()
+        ]
+        for i in range(0, len(rows), UPSERT_BATCH_SIZE):
+            # Counts are recomputed from Location, so upserting overwrites rather than adds
+            supabase.table('LocationHeatCell').upsert(
+                rows[i:i + UPSERT_BATCH_SIZE], on_conflict='user_id,precision,cell'
+            ).execute()
+        print(f"✓ Wrote {len(rows)} cells")
+
+        print("\n✅ Backfill completed successfully!")
+        print("\nNote: fixes saved while the backfill was running may be missing from")
+        print("the cells it wrote. Run it before deploying, or re-run it during a quiet period.")
+
+    except Exception as e:
+        print(f"❌ Backfill failed: {e}")
+        print("\nMake sure 'migration_add_location_history.sql' has been run first.")
+
+
+if __name__ == "__main__":
+    run_backfill()
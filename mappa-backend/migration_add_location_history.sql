@@ -0,0 +1,100 @@
+-- Migration to support location history queries and heatmap cells
+-- Run this in your Supabase SQL editor
+
+-- Make sure Location rows carry a timestamp for time-range queries
+-- The column is added without a default first so that rows stored before it
+-- existed stay NULL instead of all being stamped with the migration time.
+-- Those rows cannot be placed in time: the history endpoint skips them, but
+-- they are still counted in the heatmap.
+ALTER TABLE "Location"
+ADD COLUMN IF NOT EXISTS "created_at" TIMESTAMP WITH TIME ZONE;
+
+ALTER TABLE "Location"
+ALTER COLUMN "created_at" SET DEFAULT NOW();
+
+-- Add index for per-user time-range scans
+CREATE INDEX IF NOT EXISTS idx_location_user_created_at ON "Location"("user_id", "created_at");
+
+-- Precomputed heatmap cells, one row per user / geohash cell
+-- precision is the geohash length (the backend maintains 4, 5, 6 and 7)
+CREATE TABLE IF NOT EXISTS "LocationHeatCell" (
+    "user_id" BIGINT NOT NULL REFERENCES "User"("id") ON DELETE CASCADE,
+    "precision" SMALLINT NOT NULL,
+    "cell" TEXT NOT NULL,
+    "count" BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY ("user_id", "precision", "cell")
+);
+
+-- Increment every cell containing a new fix in a single round trip
+CREATE OR REPLACE FUNCTION increment_location_heat(p_user_id BIGINT, p_cells TEXT[])
+RETURNS VOID
+LANGUAGE SQL
+AS $$
+    INSERT INTO "LocationHeatCell" ("user_id", "precision", "cell", "count")
+    SELECT p_user_id, length(c), c, 1 FROM unnest(p_cells) AS c
+    ON CONFLICT ("user_id", "precision", "cell")
+    DO UPDATE SET "count" = "LocationHeatCell"."count" + 1;
+$$;
+
+-- Time-bucketed candidates for the history endpoint, computed in the database
+-- so the backend never downloads raw fixes. Returns the first fix of every
+-- occupied time bucket plus the first fix of every equal-count slice of the
+-- range (which fills in when fixes are clustered, e.g. daily walks) and the
+-- last fix, as one JSON document so the response is not subject to row limits.
+CREATE OR REPLACE FUNCTION location_history_candidates(
+    p_user_id BIGINT,
+    p_start TIMESTAMP WITH TIME ZONE,
+    p_end TIMESTAMP WITH TIME ZONE,
+    p_buckets INTEGER
+)
+RETURNS JSONB
+LANGUAGE SQL
+STABLE
+AS $$
+    WITH fixes AS (
+        SELECT
+            l."latitude",
+            l."longitude",
+            l."created_at",
+            EXTRACT(EPOCH FROM l."created_at")::DOUBLE PRECISION AS epoch,
+            row_number() OVER (ORDER BY l."created_at", l."id") AS rn,
+            count(*) OVER () AS total
+        FROM "Location" l
+        WHERE l."user_id" = p_user_id
+          AND l."created_at" IS NOT NULL
+          AND (p_start IS NULL OR l."created_at" >= p_start)
+          AND (p_end IS NULL OR l."created_at" <= p_end)
+    ),
+    span AS (
+        SELECT min(epoch) AS lo, max(epoch) + 1e-3 AS hi FROM fixes
+    ),
+    tagged AS (
+        SELECT
+            f.*,
+            width_bucket(f.epoch, s.lo, s.hi, p_buckets) AS time_bucket,
+            (f.rn - 1) * p_buckets / f.total AS sample_bucket
+        FROM fixes f CROSS JOIN span s
+    ),
+    firsts AS (
+        SELECT
+            t.*,
+            min(t.rn) OVER (PARTITION BY t.time_bucket) AS time_first,
+            min(t.rn) OVER (PARTITION BY t.sample_bucket) AS sample_first
+        FROM tagged t
+    )
+    SELECT jsonb_build_object(
+        'total', COALESCE(max(total), 0),
+        'fixes', COALESCE(
+            jsonb_agg(
+                jsonb_build_object('lat', "latitude", 'lng', "longitude", 'timestamp', "created_at")
+                ORDER BY rn
+            ) FILTER (WHERE rn = time_first OR rn = sample_first OR rn = total),
+            '[]'::JSONB
+        )
+    )
+    FROM firsts;
+$$;
+
+-- Existing Location rows are not in the heatmap yet. After running this
+-- migration, backfill the cells with:
+--   python backfill_location_heat.py